@@ -1,7 +1,15 @@
 import hashlib
 import os
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from functools import lru_cache, partial
 from random import randint
-from typing import List, Tuple, Dict, Any
+from typing import List, Optional, Tuple
+
+
+# Height of the GGM tree holding M * N leaves
+def _tree_height(M: int, N: int) -> int:
+    return (M - 1).bit_length() + (N - 1).bit_length()
 
 
 def find_abandon_index(M: int, N: int) -> list[int]:
@@ -9,9 +17,7 @@ def find_abandon_index(M: int, N: int) -> list[int]:
     For those trees with leaf nodes not a power of two, we use this function to find the layers at which the last node 
     can be deleted from the GGM tree.
     """
-    Lm = (M - 1).bit_length()
-    Ln = (N - 1).bit_length()
-    H = Lm + Ln
+    H = _tree_height(M, N)
 
     diff = (1 << H) - M * N
     out = []
@@ -22,32 +28,121 @@ def find_abandon_index(M: int, N: int) -> list[int]:
     return out
 
 
+@dataclass(frozen=True)
+class GGMParams:
+    """
+    Shape of the GGM tree for M * N leaves, which depends on (M, N) only: the height H, the actual
+    size of every layer (respecting the abandoned nodes), a bitmask with bit L set if the last node is
+    abandoned at (1-based) layer L, and the byte offset of every layer in the flat tree buffer (plus the
+    total length as the last entry).
+    """
+    H: int
+    sizes: Tuple[int, ...]
+    abandon_mask: int
+    offsets: Tuple[int, ...]
+
+
+# Computed once per (M, N) and shared by ggm_generate and ggm_verify
+@lru_cache(maxsize=None)
+def ggm_params(M: int, N: int) -> GGMParams:
+    H = _tree_height(M, N)
+    abandon_mask = 0
+    for L in find_abandon_index(M, N):  # 1-based layers
+        abandon_mask |= 1 << L
+    sizes = [1]
+    for d in range(H):
+        s = sizes[-1]
+        if abandon_mask & (1 << (d + 1)) and s > 0:
+            sizes.append(2 * s - 1)                  # drop last node BEFORE expanding to layer d+1
+        else:
+            sizes.append(2 * s)
+    offsets = [0]
+    for s in sizes:
+        offsets.append(offsets[-1] + 16 * s)
+    return GGMParams(H, tuple(sizes), abandon_mask, tuple(offsets))
+
+
 def prg_split_shake_16(key: bytes) -> Tuple[bytes, bytes]:
     stream = hashlib.shake_256(key).digest(32)
     return stream[:16], stream[16:]
 
 
+def prg_split_shake_16_batch(keys: bytes, n: int) -> bytes:
+    """
+    Batched version of prg_split_shake_16: expand n packed 16-byte keys in a single pass.
+    Key k is read from keys[16k:16k+16], and its 32-byte stream (left || right child) is
+    written to [32k:32k+32] of the output.
+    """
+    return b"".join([hashlib.shake_256(keys[i:i + 16]).digest(32) for i in range(0, 16 * n, 16)])
+
 
-# Expand the seeds at layer i to two children nodes at the layer i+1
-def ggm_generate(seed: bytes, M: int, N: int) -> List[List[bytes]]:
-    abandon_layers = set(find_abandon_index(M, N))
-    H = (M - 1).bit_length() + (N - 1).bit_length()
-    layers: List[List[bytes]] = [[seed]]
+# Expand the seeds at layer i to two children nodes at the layer i+1.
+# The seed is the root node and, like every node of the tree, must be 16 bytes.
+def ggm_generate(seed: bytes, params: GGMParams) -> List[memoryview]:
+    if len(seed) != 16:
+        raise ValueError(f"seed must be 16 bytes, got {len(seed)}")
+    sizes = params.sizes
+    offsets = params.offsets  # the whole expansion schedule is fixed by the shape
+    H = params.H
+    # The whole tree lives in one flat buffer, layer after layer; node k of a layer is at [16k:16k+16]
+    tree = memoryview(bytearray(offsets[-1]))
+    tree[:16] = seed
     for d in range(H):
-        current = layers[d]  # a list with current nodes
-        next_level: List[bytes] = []
-        for node in current:
-            L, R = prg_split_shake_16(node)
-            next_level.append(L)
-            next_level.append(R)
-        if (d + 1) in abandon_layers:
-            layers.append(next_level[:-1])
-        else:
-            layers.append(next_level)
-    return layers
+        stream = prg_split_shake_16_batch(tree[offsets[d]:offsets[d + 1]], sizes[d])
+        # the layer is shorter than the stream if layer d+1 was abandoned; no copy just to trim it
+        tree[offsets[d + 1]:offsets[d + 2]] = memoryview(stream)[:offsets[d + 2] - offsets[d + 1]]
+    return [tree[offsets[d]:offsets[d + 1]] for d in range(H + 1)]
 
 
-def ggm_open(layers: List[List[bytes]], A: List[int]) -> list[dict[str, Any]]:
+@dataclass(slots=True, frozen=True)
+class ProofStep:
+    """
+    One layer of the octopus proof: the nodes of that layer the verifier cannot derive by itself.
+    """
+    layer: int
+    indices: Tuple[int, ...]
+    values: Tuple[bytes, ...]
+
+
+# Byte tables for moving between bitmasks and index lists without a Python loop per bit
+_NONZERO = bytes([0] + [1] * 255)
+_EVEN_BITS = bytes(sum(((b >> (2 * k)) & 1) << k for k in range(4)) for b in range(256))
+
+
+def _mask_from_indices(indices: List[int]) -> int:
+    if not indices:
+        return 0
+    bitmap = bytearray(max(indices) // 8 + 1)
+    for i in indices:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+def _indices_from_mask(mask: int) -> List[int]:
+    data = mask.to_bytes((mask.bit_length() + 7) // 8, "little")
+    nonzero = data.translate(_NONZERO)
+    out = []
+    j = nonzero.find(1)
+    while j >= 0:
+        byte = data[j]
+        while byte:
+            low = byte & -byte
+            out.append(8 * j + low.bit_length() - 1)
+            byte ^= low
+        j = nonzero.find(1, j + 1)
+    return out
+
+
+def _halve_pairs(pairs: int) -> int:
+    """
+    Map bit 2k of pairs (the pair of nodes (2k, 2k+1)) to bit k, i.e. to the parent of the pair.
+    """
+    data = pairs.to_bytes((pairs.bit_length() + 7) // 8, "little")
+    halves = data.translate(_EVEN_BITS)  # byte j now holds the 4 parent bits of byte j
+    return int.from_bytes(halves[0::2], "little") | (int.from_bytes(halves[1::2], "little") << 4)
+
+
+def ggm_open(layers: List[memoryview], A: List[int]) -> List[ProofStep]:
     """
     This function generates octopus proof for multiple openings in the GGM tree. 
 
@@ -56,103 +151,135 @@ def ggm_open(layers: List[List[bytes]], A: List[int]) -> list[dict[str, Any]]:
     whose children nodes are not in the subtree.  
     """
     H = len(layers) - 1
-    target = sorted(set(A))
-    opening: List[Dict[str, Any]] = []
+    # Sets of node indices are kept as bitmasks: bit i stands for node i of the current layer
+    target = _mask_from_indices(A)
+    even = int.from_bytes(b"\x55" * (target.bit_length() // 8 + 1), "little")  # bits 0, 2, 4, ...
+    opening: List[ProofStep] = []
     for L in range(H, 0, -1):
         if not target:
-            # Nothing more to prove; still record an empty step for completeness
-            opening.append({"layer": L, "indices": [], "values": []})
-            target = []  # stay empty going up
-            continue
-        pairs = []
-        for i in target:
-            sib = i ^ 1
-            pairs.append((min(i, sib), max(i, sib)))  # label of the challenge and its sibling
-        B_pruned = sorted(set(pairs))
-        flat = {x for p in B_pruned for x in p}
-        need = sorted(flat.difference(target))
-        layer_size = len(layers[L])
-        need = [i for i in need if i < layer_size]
-        opening.append({
-            "layer": L,
-            "indices": need,
-            "values": [layers[L][k] for k in need],
-        })
-
-        # Parents for next iteration (even index from each pair, halved)
-        parents = sorted({p[0] // 2 for p in B_pruned})
-        target = parents
+            # Nothing more to prove; the verifier has no use for empty steps
+            break
+        layer = layers[L]
+        layer_size = len(layer) // 16
+        # label of the challenge and its sibling: the pair (i & ~1, i | 1), kept as its even bit
+        pairs = (target | (target >> 1)) & even
+        need = _indices_from_mask((pairs | (pairs << 1)) & ~target & ((1 << layer_size) - 1))
+        opening.append(ProofStep(L, tuple(need), tuple([bytes(layer[16 * k:16 * k + 16]) for k in need])))
 
-    return opening
+        # Parents for next iteration: every pair (2k, 2k+1) collapses to bit k
+        target = _halve_pairs(pairs)
 
-# Compute actual layer size (respect the abandoned nodes)
-def _layer_sizes_from_MN(M: int, N: int) -> list[int]:
-    H = (M - 1).bit_length() + (N - 1).bit_length()
-    abandon = set(find_abandon_index(M, N))  # 1-based layers
-    sizes = [1]
-    for d in range(H):
-        s = sizes[-1]
-        if (d + 1) in abandon and s > 0:
-            sizes.append(2 * s - 1)                  # drop last node BEFORE expanding to layer d+1
-        else:
-            sizes.append(2 * s)
-    return sizes
+    return opening
 
-# expand a subtree to leaves
-def _expand_to_leaves(node: bytes,start_layer: int, node_index: int, H: int, sizes: list[int],) -> tuple[int, list[bytes]]:
-    level_nodes = [node]
+# expand a subtree down to layer H (the leaves, unless a shallower layer is asked for)
+def _expand_to_leaves(node: bytes,start_layer: int, node_index: int, H: int, params: GGMParams,) -> tuple[int, bytes]:
+    if start_layer == H:
+        return node_index, node  # already a leaf
+    level_nodes = node  # packed, 16 bytes per node
     lo = hi = node_index
+    abandon_mask = params.abandon_mask
     for d in range(start_layer, H):  # produce layer d+1
-        nxt = []
-        for x in level_nodes:
-            Lc, Rc = prg_split_shake_16(x)
-            nxt.append(Lc)
-            nxt.append(Rc)
+        nxt = prg_split_shake_16_batch(level_nodes, hi - lo + 1)
 
         # interval if no pruning at next layer
         lo2, hi2 = 2 * lo, 2 * hi + 1
 
-        # if layer d+1 was abandoned, drop the very last node of that layer
-        last_global = sizes[d + 1]
-        if lo2 <= last_global <= hi2:
-            nxt = nxt[:-1]
+        # if layer d+1 was abandoned, drop the very last node of that layer (index sizes[d + 1]) when it
+        # falls in this subtree; it is left in the buffer and simply not expanded, since the PRG only
+        # reads hi - lo + 1 keys
+        if abandon_mask & (1 << (d + 1)) and hi2 == params.sizes[d + 1]:
             hi2 -= 1
 
         level_nodes = nxt
         lo, hi = lo2, hi2
 
-    return lo, level_nodes
+    return lo, level_nodes[:16 * (hi - lo + 1)]
+
+
+# Number of roughly equal jobs ggm_verify cuts the leaves into when it runs on an executor
+_VERIFY_JOBS = 64
+
+
+def _expand_group(group: List[Tuple[bytes, int, int]], params: GGMParams) -> List[Tuple[int, bytes]]:
+    return [_expand_to_leaves(node, L, i, params.H, params) for node, L, i in group]
+
+
+def _schedule_subtrees(subtrees: List[Tuple[bytes, int, int]], params: GGMParams) -> List[List[Tuple[bytes, int, int]]]:
+    """
+    Cut the (node, layer, index) subtrees into groups of about total / _VERIFY_JOBS leaves, largest first.
+    A subtree rooted above the layer D where subtrees have that size is first expanded in place down to D,
+    and each of its nodes at D becomes a job; the smaller subtrees below D are packed together in layer order.
+    """
+    H = params.H
+    depth = max(0, (params.sizes[-1] // _VERIFY_JOBS).bit_length() - 1)  # a job spans about 2**depth leaves
+    D = H - depth
+    groups: List[List[Tuple[bytes, int, int]]] = []
+    small = []
+    for node, L, i in subtrees:
+        if L < D:
+            lo, nodes = _expand_to_leaves(node, L, i, D, params)
+            groups.extend([(nodes[k:k + 16], D, lo + k // 16)] for k in range(0, len(nodes), 16))
+        else:
+            small.append((node, L, i))
+
+    small.sort(key=lambda job: job[1])
+    group, leaves = [], 0
+    for job in small:
+        group.append(job)
+        leaves += 1 << (H - job[1])
+        if leaves >= 1 << depth:
+            groups.append(group)
+            group, leaves = [], 0
+    if group:
+        groups.append(group)
+    return groups
 
 
 # Using the octopus opening to recover all the leaf nodes except for those in the challenge set
-def ggm_verify(proof: List[Dict[str, Any]], M: int, N: int) -> List[bytes]:
-    sizes = _layer_sizes_from_MN(M, N)
-    H = len(sizes) - 1
+def ggm_verify(proof: List[ProofStep], params: GGMParams, executor: Optional[Executor] = None) -> Tuple[bytearray, List[int]]:
+    """
+    Returns the recovered leaves packed like the tree layers, leaf i at [16i:16i+16], together with the
+    sorted indices of the leaves the proof does not cover (the challenge set). Their 16 bytes are left
+    as zeros in the buffer, so use the index list, not the contents, to tell them apart.
+
+    The subtrees below the proof values are disjoint, so with an executor they are cut into roughly equal
+    jobs and expanded on it. Use a ProcessPoolExecutor kept by the caller: the PRG holds the GIL on 16-byte
+    inputs, so threads would not run in parallel.
+    """
+    sizes = params.sizes
+    H = params.H
     total = sizes[-1]
-    recovered: List[bytes] = [b''] * total
-
-    for level in proof:
-        L = level["layer"]
-        idxs = level.get("indices", [])
-        vals = level.get("values", [])
-        for i, node in zip(idxs, vals):
-            base, leaves = _expand_to_leaves(node, L, i, H, sizes)
-            for off, leaf in enumerate(leaves):
-                gi = base + off
-                if 0 <= gi < total:
-                    recovered[gi] = leaf
-                else:
-                    raise IndexError(f"leaf index {gi} out of range 0..{total - 1}")
-    return recovered
+    recovered = bytearray(16 * total)
+
+    subtrees = [(node, step.layer, i) for step in proof for i, node in zip(step.indices, step.values)]
+    if executor is None:
+        results = [_expand_to_leaves(node, L, i, H, params) for node, L, i in subtrees]
+    else:
+        groups = _schedule_subtrees(subtrees, params)
+        results = [r for rs in executor.map(partial(_expand_group, params=params), groups) for r in rs]
+
+    missing: List[int] = []
+    covered = 0  # leaves below this index are either recovered or already listed as missing
+    for base, leaves in sorted(results, key=lambda r: r[0]):
+        end = base + len(leaves) // 16
+        if base < 0 or end > total:
+            gi = base if base < 0 or base >= total else total
+            raise IndexError(f"leaf index {gi} out of range 0..{total - 1}")
+        recovered[16 * base:16 * end] = leaves  # a subtree's leaves are contiguous
+        missing.extend(range(covered, base))
+        covered = max(covered, end)
+    missing.extend(range(covered, total))
+    return recovered, missing
 
 
 if __name__ == '__main__':
     # An example 
     M = 3
     N = 4
+    params = ggm_params(M, N)
     # Expand the sd to obtain a GGM tree
     sd = os.urandom(16)
-    tree = ggm_generate(sd, M, N)
+    tree = ggm_generate(sd, params)
     
     # simulate the BAVC opening
     challenge_ind: List[int] = []
@@ -162,4 +289,4 @@ if __name__ == '__main__':
     # Compute the opening
     proof = ggm_open(tree, challenge_ind)
     # Verify the path (get the leaves except for those in the challenge set)
-    recovered_leaves = ggm_verify(proof, M, N)
+    recovered_leaves, missing = ggm_verify(proof, params)